@@ -25,7 +25,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from typing import Dict, Sequence, Tuple, Text
+import heapq
+from typing import Dict, List, Sequence, Tuple, Text, Union
+import weakref
 
 from absl import logging
 from ddsp import core
@@ -36,6 +38,7 @@ tfkl = tf.keras.layers
 
 # Define Types.
 TensorDict = Dict[Text, tf.Tensor]
+FlatTensors = Sequence[tf.Tensor]
 
 
 # Processor Base Class ---------------------------------------------------------
@@ -67,6 +70,28 @@ class Processor(tfkl.Layer):
     signal = self.get_signal(**controls)
     return signal
 
+  def get_outputs(self,
+                  *args: tf.Tensor,
+                  keep_controls: bool = True,
+                  **kwargs: tf.Tensor) -> TensorDict:
+    """Convert input tensor arguments into a nested dict of outputs.
+
+    Args:
+      *args: Input tensors passed to get_controls().
+      keep_controls: Include the controls in the outputs. If False, only the
+        signal is returned and the controls can be freed after use.
+      **kwargs: Input tensors passed to get_controls().
+
+    Returns:
+      Dictionary of the form {name: {'controls': controls, 'signal': signal}}.
+    """
+    controls = self.get_controls(*args, **kwargs)
+    signal = self.get_signal(**controls)
+    if keep_controls:
+      return {self.name: {'controls': controls, 'signal': signal}}
+    else:
+      return {self.name: {'signal': signal}}
+
   def get_controls(self, *args: tf.Tensor, **kwargs: tf.Tensor) -> TensorDict:
     """Convert input tensor arguments into a dict of processor controls."""
     raise NotImplementedError
@@ -80,31 +105,174 @@ class Processor(tfkl.Layer):
 # Define Types.
 Node = Tuple[Processor, Sequence[Text]]
 DAG = Sequence[Node]
+Path = Tuple[Text, ...]
+
+
+def _lookup(nested_dict: TensorDict, path: Path) -> tf.Tensor:
+  """Returns the value of a nested dict for a pre-split key path."""
+  value = nested_dict
+  for key in path:
+    value = value[key]
+  return value
 
 
 @gin.configurable
 class ProcessorGroup(tfkl.Layer):
   """String Proccesor() objects together into a processor_group."""
 
-  def __init__(self, dag: DAG, name: Text = 'processor_group'):
+  def __init__(self,
+               dag: DAG,
+               name: Text = 'processor_group',
+               use_tf_function: bool = False,
+               jit_compile: bool = False,
+               keep_controls: bool = True):
     """Constructor.
 
     Args:
       dag: A directed acyclical graph in the form of an iterable of tuples or
-        dictionaries. Tuples are intepreted as (processor, [inputs]).
+        dictionaries. Tuples are intepreted as (processor, [inputs]) and
+        dictionaries as {"processor": processor, "inputs": [inputs]}.
         "Processor" should be an instance of a Processor() object. "Inputs" is
         an iterable of strings each of which is a nested dict key. For example,
         "synth_additive/controls/f0_hz" would correspond to the value
-        {"synth_additive": {"controls": {"f0_hz": value}}}.  The graph is read
-        sequentially and must be topologically sorted. This means that all
-        inputs for a processor must already be generated by earlier processors
-        (or inputs to the processor_group).
+        {"synth_additive": {"controls": {"f0_hz": value}}}. Nodes are
+        scheduled by their dependencies, so the graph doesn't need to be
+        topologically sorted, but the last node is always the output of the
+        processor_group. Processor names must be unique.
       name: Name of processor_group.
+      use_tf_function: Run the DAG as a tf.function, which is traced on the
+        first call to get_outputs() (and retraced for new input shapes),
+        removing python overhead from the forward pass.
+      jit_compile: Compile the traced DAG with XLA. Only used if
+        use_tf_function=True.
+      keep_controls: Include the controls of every processor in the outputs.
+        If False, only controls that are inputs to other processors are kept,
+        which avoids holding on to unused tensors during inference.
+
+    Raises:
+      ValueError: If the dag contains a cycle or duplicate processor names.
     """
     super(ProcessorGroup, self).__init__(name=name)
     self.dag = dag
+    self.use_tf_function = use_tf_function
+    self.jit_compile = jit_compile
+    self.keep_controls = keep_controls
+    # Pair each processor with its input keys into the flat output store.
+    self._plan = [self._parse_node(node) for node in self.dag]
     # Collect a list of processors.
-    self.processors = [node[0] for node in self.dag]
+    self.processors = [processor for processor, _ in self._plan]
+    # The last processor in the dag gives the output signal.
+    self._output_name = self.processors[-1].name
+    # Keys of the inputs read from outside of the processor_group.
+    processor_names = set(processor.name for processor in self.processors)
+    self._input_keys = tuple(sorted(set(
+        key for _, keys in self._plan for key in keys
+        if key.split('/')[0] not in processor_names)))
+    # Names of processors whose controls are kept in the outputs.
+    if self.keep_controls:
+      self._keep_controls = processor_names
+    else:
+      self._keep_controls = set(
+          key.split('/')[0] for _, keys in self._plan for key in keys
+          if key.split('/')[1:2] == ['controls'])
+    # Sort the plan so nodes run after the nodes they depend on.
+    self._plan = self._schedule(self._plan)
+    # Pre-split the keys that are read, so only those values are looked up and
+    # stored in the flat output store, {"key/key/key": value}.
+    read_keys = sorted(set(key for _, keys in self._plan for key in keys))
+    self._input_paths = [(key, tuple(key.split('/')))
+                         for key in self._input_keys]
+    self._node_reads = {name: [] for name in processor_names}
+    for key in read_keys:
+      path = tuple(key.split('/'))
+      if path[0] in self._node_reads:
+        self._node_reads[path[0]].append((key, path))
+
+    # Logging, in execution order.
+    for processor, keys in self._plan:
+      logging.info('Connecting node (%s):', processor.name)
+      for i, key in enumerate(keys):
+        logging.info('Input %d: %s', i, key)
+    logging.info('ProcessorGroup output node (%s)', self._output_name)
+
+    # One tf.function per graph, as variables are created in the graph where
+    # the processors are built.
+    self._traced_fns = weakref.WeakKeyDictionary()
+
+  @staticmethod
+  def _parse_node(node) -> Node:
+    """Get the (processor, [input keys]) of a tuple or dictionary node."""
+    if isinstance(node, dict):
+      return node['processor'], list(node['inputs'])
+    else:
+      return node[0], list(node[1])
+
+  @staticmethod
+  def _schedule(plan: List[Node]) -> List[Node]:
+    """Topologically sort nodes with Kahn's algorithm.
+
+    Args:
+      plan: List of (processor, [input keys]) nodes.
+
+    Returns:
+      List of nodes that only depend on earlier nodes (or inputs to the
+        processor_group). A plan that is already sorted keeps its order.
+
+    Raises:
+      ValueError: If the nodes contain a cycle or duplicate processor names.
+    """
+    node_idx = {processor.name: i for i, (processor, _) in enumerate(plan)}
+    if len(node_idx) != len(plan):
+      names = [processor.name for processor, _ in plan]
+      duplicates = sorted(set(n for n in names if names.count(n) > 1))
+      raise ValueError('Processor names in a processor_group dag must be '
+                       'unique, found duplicates: {}'.format(duplicates))
+    # Adjacency list from each node to the nodes that consume its outputs.
+    consumers = [[] for _ in plan]
+    in_degree = [0] * len(plan)
+    for i, (_, keys) in enumerate(plan):
+      producers = set(key.split('/')[0] for key in keys)
+      for j in sorted(node_idx[p] for p in producers if p in node_idx):
+        consumers[j].append(i)
+        in_degree[i] += 1
+
+    # Always run the earliest ready node, to keep the order of the dag.
+    order = []
+    ready = [i for i, degree in enumerate(in_degree) if degree == 0]
+    heapq.heapify(ready)
+    while ready:
+      i = heapq.heappop(ready)
+      order.append(plan[i])
+      for j in consumers[i]:
+        in_degree[j] -= 1
+        if in_degree[j] == 0:
+          heapq.heappush(ready, j)
+
+    if len(order) != len(plan):
+      raise ValueError('The processor_group dag contains a cycle, only {} of '
+                       '{} nodes could be scheduled.'.format(
+                           len(order), len(plan)))
+    return order
+
+  @property
+  def input_keys(self) -> Tuple[Text, ...]:
+    """Flat keys of the inputs the dag reads from outside the group."""
+    return self._input_keys
+
+  def flatten(self, dag_inputs: TensorDict) -> FlatTensors:
+    """Flatten a nested dictionary of inputs into a tuple of tensors.
+
+    Useful for converting dict-structured datasets into flat tuples upstream,
+    for example `dataset.map(processor_group.flatten)`.
+
+    Args:
+      dag_inputs: A nested dictionary of input tensors, as for get_outputs().
+
+    Returns:
+      A tuple of tensors in the same order as input_keys. Can be passed
+        directly to get_outputs().
+    """
+    return tuple(_lookup(dag_inputs, path) for _, path in self._input_paths)
 
   def call(self, *args: tf.Tensor, **kwargs: tf.Tensor) -> tf.Tensor:
     """Alias for get_signal()."""
@@ -116,48 +284,98 @@ class ProcessorGroup(tfkl.Layer):
     signal = outputs[self.name]['signal']
     return signal
 
-  def get_outputs(self, dag_inputs: TensorDict) -> TensorDict:
+  def get_outputs(self,
+                  dag_inputs: Union[TensorDict, FlatTensors]) -> TensorDict:
     """Run the DAG and get complete outputs dictionary for the processor_group.
 
     Args:
       dag_inputs: A dictionary of input tensors fed to the signal processing
-        processor_group.
+        processor_group. Alternatively a tuple of tensors in the order of
+        input_keys, such as the output of flatten(). The inputs are not
+        modified.
 
     Returns:
       outputs: A nested dictionary of all the output tensors.
-    """
-    # Initialize the outputs with inputs to the processor_group.
-    outputs = dag_inputs
-
-    # Run through the DAG nodes in sequential order.
-    for node in self.dag:
-      # Get the node processor and keys to the node input.
-      processor, keys = node
 
-      # Logging.
-      logging.info('Connecting node (%s):', processor.name)
-      for i, key in enumerate(keys):
-        logging.info('Input %d: %s', i, key)
-
-      # Get the inputs to the node.
-      inputs = [core.nested_lookup(key, outputs) for key in keys]
-
-      # Build the processor (does nothing if not the first time).
-      processor.build([tensor.shape for tensor in inputs])
-      # Run processor.
-      controls = processor.get_controls(*inputs)
-      signal = processor.get_signal(**controls)
+    Raises:
+      ValueError: If a tuple of inputs doesn't match the length of input_keys.
+    """
+    if isinstance(dag_inputs, (tuple, list)):
+      if len(dag_inputs) != len(self.input_keys):
+        raise ValueError('Expected {} flat inputs for the keys {}, got {}.'
+                         .format(len(self.input_keys), self.input_keys,
+                                 len(dag_inputs)))
+      # Nest the flat inputs according to their keys.
+      nested_inputs = {}
+      for (_, path), tensor in zip(self._input_paths, dag_inputs):
+        inner = nested_inputs
+        for key in path[:-1]:
+          inner = inner.setdefault(key, {})
+        inner[path[-1]] = tensor
+      dag_inputs = nested_inputs
+
+    if self.use_tf_function:
+      return self._get_traced_outputs(dag_inputs)
+    else:
+      return self._run_dag(dag_inputs)
+
+  def _get_traced_outputs(self, dag_inputs: TensorDict) -> TensorDict:
+    """Run the DAG as a tf.function of the current graph."""
+    graph = tf.get_default_graph()
+    traced_fn = self._traced_fns.get(graph)
+    if traced_fn is None:
+      traced = []
+
+      def run_dag(dag_inputs):
+        # Only build (create variables) during the first trace, tf.function
+        # doesn't allow creating variables when retracing for new shapes.
+        outputs = self._run_dag(dag_inputs, build=not traced)
+        traced.append(True)
+        return outputs
+
+      traced_fn = tf.function(run_dag, experimental_compile=self.jit_compile)
+      self._traced_fns[graph] = traced_fn
+    return traced_fn(dag_inputs)
+
+  def _run_dag(self, dag_inputs: TensorDict, build: bool = True) -> TensorDict:
+    """Run through the DAG nodes and collect all outputs."""
+    # Initialize the outputs with a copy of the inputs to the processor_group.
+    outputs = dict(dag_inputs)
+    # Flat store of the values read by the nodes, for fast input lookup.
+    flat_outputs = {key: _lookup(dag_inputs, path)
+                    for key, path in self._input_paths}
+
+    # Run through the DAG nodes in topological order.
+    for node in self._plan:
+      node_outputs = self._run_node(node, flat_outputs, build)
 
       #  Add outputs to the dictionary.
-      outputs[processor.name] = {'controls': controls, 'signal': signal}
+      outputs.update(node_outputs)
+      for key, path in self._node_reads[node[0].name]:
+        flat_outputs[key] = _lookup(node_outputs, path)
 
     # Get output signal from last processor.
-    output_name = self.processors[-1].name
-    outputs[self.name] = {'signal': outputs[output_name]['signal']}
-    logging.info('ProcessorGroup output node (%s)', output_name)
+    outputs[self.name] = {'signal': outputs[self._output_name]['signal']}
 
     return outputs
 
+  def _run_node(self,
+                node: Node,
+                flat_outputs: TensorDict,
+                build: bool = True) -> TensorDict:
+    """Run a single processor on its inputs from the flat output store."""
+    processor, keys = node
+
+    # Get the inputs to the node.
+    inputs = [flat_outputs[key] for key in keys]
+
+    # Build the processor (does nothing if not the first time).
+    if build:
+      processor.build([tensor.shape for tensor in inputs])
+    # Run processor.
+    keep_controls = processor.name in self._keep_controls
+    return processor.get_outputs(*inputs, keep_controls=keep_controls)
+
 
 # Routing processors for manipulating signals in a processor_group -------------
 @gin.register
@@ -167,6 +385,22 @@ class Add(Processor):
   def __init__(self, name: Text = 'add'):
     super(Add, self).__init__(name=name)
 
+  def call(self, signal_one: tf.Tensor, signal_two: tf.Tensor) -> tf.Tensor:
+    """Skip the pass-through controls dict."""
+    return self.get_signal(signal_one, signal_two)
+
+  def get_outputs(self,
+                  signal_one: tf.Tensor,
+                  signal_two: tf.Tensor,
+                  keep_controls: bool = True) -> TensorDict:
+    """Skip get_controls(), only building the controls dict if it is kept."""
+    signal = self.get_signal(signal_one, signal_two)
+    if keep_controls:
+      controls = {'signal_one': signal_one, 'signal_two': signal_two}
+      return {self.name: {'controls': controls, 'signal': signal}}
+    else:
+      return {self.name: {'signal': signal}}
+
   def get_controls(self, signal_one: tf.Tensor,
                    signal_two: tf.Tensor) -> TensorDict:
     """Just pass signals through."""
@@ -177,12 +411,39 @@ class Add(Processor):
     return signal_one + signal_two
 
 
+def _crossfade(signal_one: tf.Tensor, signal_two: tf.Tensor,
+               mix_level: tf.Tensor) -> tf.Tensor:
+  """Elementwise constant-power crossfade, see Mix.get_signal()."""
+  # No abs() needed, mix_level is in the range [0, 1].
+  mix_level_one = tf.sqrt(mix_level)
+  mix_level_two = 1.0 - tf.sqrt(1.0 - mix_level)
+  return mix_level_one * signal_one + mix_level_two * signal_two
+
+
 @gin.register
 class Mix(Processor):
   """Constant-power crossfade between two signals."""
 
-  def __init__(self, name: Text = 'mix'):
+  def __init__(self, name: Text = 'mix', jit_compile: bool = False):
+    """Constructor.
+
+    Args:
+      name: Name of processor module.
+      jit_compile: Compile the crossfade with XLA, fusing the elementwise ops
+        into a single kernel.
+    """
     super(Mix, self).__init__(name=name)
+    self.jit_compile = jit_compile
+    if self.jit_compile:
+      self._crossfade = tf.function(_crossfade, experimental_compile=True)
+    else:
+      self._crossfade = _crossfade
+
+  def call(self, signal_one: tf.Tensor, signal_two: tf.Tensor,
+           nn_out_mix_level: tf.Tensor) -> tf.Tensor:
+    """Pass controls positionally, the signals pass through unchanged."""
+    controls = self.get_controls(signal_one, signal_two, nn_out_mix_level)
+    return self.get_signal(signal_one, signal_two, controls['mix_level'])
 
   def get_controls(self, signal_one: tf.Tensor, signal_two: tf.Tensor,
                    nn_out_mix_level: tf.Tensor) -> TensorDict:
@@ -228,6 +489,4 @@ class Mix(Processor):
     Returns:
       Tensor of mixed output signal.
     """
-    mix_level_one = tf.sqrt(tf.abs(mix_level))
-    mix_level_two = 1.0 - tf.sqrt(tf.abs(mix_level - 1.0))
-    return mix_level_one * signal_one + mix_level_two * signal_two
+    return self._crossfade(signal_one, signal_two, mix_level)
@@ -84,15 +84,162 @@ class ProcessorGroupTest(parameterized.TestCase, tf.test.TestCase):
       tensor = core.nested_lookup(tensor_string, outputs)
       self.assertIsInstance(tensor, (np.ndarray, tf.Tensor))
 
-  def test_dag_construction(self):
+  @parameterized.named_parameters(
+      ('python', False),
+      ('tf_function', True),
+  )
+  def test_dag_construction(self, use_tf_function):
     """Tests if DAG is built properly and runs.
     """
+    processor_group = processors.ProcessorGroup(
+        dag=self.dag,
+        name='processor_group',
+        use_tf_function=use_tf_function)
+    outputs = processor_group.get_outputs(self.nn_outputs)
+    self.assertIsInstance(outputs, dict)
+    self._check_tensor_outputs(self.expected_outputs, outputs)
+
+  def test_dag_of_dictionaries(self):
+    """Tests that nodes can be specified as dictionaries."""
+    dag = [{'processor': p, 'inputs': keys} for p, keys in self.dag]
+    processor_group = processors.ProcessorGroup(dag=dag,
+                                                name='processor_group')
+    outputs = processor_group.get_outputs(self.nn_outputs)
+    self._check_tensor_outputs(self.expected_outputs, outputs)
+
+  def test_dag_without_controls(self):
+    """Tests that only controls used as inputs are kept."""
+    dag = self.dag + [(processors.Add(name='add_controls'),
+                       ['add/controls/signal_one', 'reverb/signal'])]
+    processor_group = processors.ProcessorGroup(dag=dag,
+                                                name='processor_group',
+                                                keep_controls=False)
+    outputs = processor_group.get_outputs(self.nn_outputs)
+    self._check_tensor_outputs(
+        ['additive/signal', 'add/controls/signal_one', 'reverb/signal',
+         'processor_group/signal'], outputs)
+    self.assertNotIn('controls', outputs['additive'])
+    self.assertNotIn('controls', outputs['reverb'])
+
+  def test_dag_inputs_are_not_modified(self):
+    """Tests that outputs are added to a copy of the input dictionary."""
+    processor_group = processors.ProcessorGroup(dag=self.dag,
+                                                name='processor_group')
+    dag_inputs = dict(self.nn_outputs)
+    outputs = processor_group.get_outputs(dag_inputs)
+    self.assertSetEqual(set(self.nn_outputs.keys()), set(dag_inputs.keys()))
+    self.assertIn('processor_group', outputs)
+
+  def test_flat_inputs(self):
+    """Tests running the DAG on a flat tuple of inputs from tf.data."""
     processor_group = processors.ProcessorGroup(dag=self.dag,
                                                 name='processor_group')
+    self.assertTupleEqual(
+        ('amps', 'f0_hz', 'harmonic_distribution', 'magnitudes'),
+        processor_group.input_keys)
+    dataset = tf.data.Dataset.from_tensors(self.nn_outputs)
+    dataset = dataset.map(processor_group.flatten)
+    tensors = tf.data.make_one_shot_iterator(dataset).get_next()
+    self.assertLen(tensors, 4)
+    outputs = processor_group.get_outputs(tensors)
+    self._check_tensor_outputs(self.expected_outputs[:4], outputs)
+    self._check_tensor_outputs(self.expected_outputs[5:], outputs)
+
+  def test_flat_inputs_of_wrong_length_raise_error(self):
+    """Tests that a flat tuple must have a tensor for every input key."""
+    processor_group = processors.ProcessorGroup(dag=self.dag,
+                                                name='processor_group')
+    tensors = processor_group.flatten(self.nn_outputs)
+    with self.assertRaisesRegex(ValueError, 'magnitudes'):
+      processor_group.get_outputs(tensors[:-1])
+
+  def test_tf_function_retraces_for_new_batch_size(self):
+    """Tests calling the traced DAG with inputs of different shapes."""
+    processor_group = processors.ProcessorGroup(dag=self.dag,
+                                                name='processor_group',
+                                                use_tf_function=True)
+    for n_batch in [self.n_batch, 2]:
+      nn_outputs = {k: v[:n_batch] for k, v in self.nn_outputs.items()}
+      outputs = processor_group.get_outputs(nn_outputs)
+      self._check_tensor_outputs(self.expected_outputs, outputs)
+      signal = outputs['processor_group']['signal']
+      self.assertEqual(n_batch, int(signal.shape[0]))
+
+      with self.cached_session() as sess:
+        sess.run(tf.global_variables_initializer())
+        signal = sess.run(signal)
+      self.assertEqual(n_batch, signal.shape[0])
+      self.assertTrue(np.all(np.isfinite(signal)))
+
+  @parameterized.named_parameters(
+      ('tf_function', False),
+      ('jit_compile', True),
+  )
+  def test_tf_function_matches_python(self, jit_compile):
+    """Tests that the traced DAG computes the same signal as python."""
+    # Fixed impulse response, so both DAGs use the same weights.
+    dag = [
+        (synths.Additive(name='additive'),
+         ['amps', 'harmonic_distribution', 'f0_hz']),
+        (effects.Reverb(trainable=False, name='reverb'),
+         ['additive/signal', 'ir']),
+    ]
+    nn_outputs = dict(self.nn_outputs)
+    nn_outputs['ir'] = 1e-2 * np.random.randn(self.n_batch, 100)
+
+    signals = []
+    for use_tf_function in [False, True]:
+      processor_group = processors.ProcessorGroup(
+          dag=dag,
+          name='processor_group',
+          use_tf_function=use_tf_function,
+          jit_compile=jit_compile)
+      signals.append(processor_group.get_signal(nn_outputs))
+
+    with self.cached_session() as sess:
+      sess.run(tf.global_variables_initializer())
+      python_signal, traced_signal = sess.run(signals)
+
+    self.assertAllClose(python_signal, traced_signal, rtol=1e-4, atol=1e-4)
+
+  def test_tf_function_in_separate_graphs(self):
+    """Tests that each graph gets its own traced DAG and variables."""
+    processor_group = processors.ProcessorGroup(dag=self.dag,
+                                                name='processor_group',
+                                                use_tf_function=True)
+    for _ in range(2):
+      graph = tf.Graph()
+      with graph.as_default():
+        outputs = processor_group.get_outputs(self.nn_outputs)
+        signal = outputs['processor_group']['signal']
+        self.assertIs(graph, signal.graph)
+
+  def test_dag_does_not_need_to_be_sorted(self):
+    """Tests that nodes are scheduled by their dependencies."""
+    dag = [self.dag[2], self.dag[1], self.dag[0], self.dag[3]]
+    processor_group = processors.ProcessorGroup(dag=dag,
+                                                name='processor_group')
     outputs = processor_group.get_outputs(self.nn_outputs)
-    self.assertIsInstance(outputs, dict)
     self._check_tensor_outputs(self.expected_outputs, outputs)
 
+  def test_dag_with_cycle_raises_error(self):
+    """Tests that a cyclical DAG is rejected at construction."""
+    dag = [
+        (processors.Add(name='add_1'), ['add_2/signal', 'amps']),
+        (processors.Add(name='add_2'), ['add_1/signal', 'amps']),
+    ]
+    with self.assertRaises(ValueError):
+      processors.ProcessorGroup(dag=dag, name='processor_group')
+
+  def test_dag_with_duplicate_names_raises_error(self):
+    """Tests that processors with the same name are rejected."""
+    dag = [
+        (processors.Add(name='add'), ['amps', 'amps']),
+        (processors.Add(name='add'), ['add/signal', 'amps']),
+    ]
+    with self.assertRaisesRegex(ValueError, 'unique'):
+      processors.ProcessorGroup(dag=dag, name='processor_group')
+
 
 class AddTest(tf.test.TestCase):
 
@@ -109,11 +256,29 @@ class AddTest(tf.test.TestCase):
 
     self.assertAllEqual(expected, actual)
 
+  def test_get_outputs_without_controls(self):
+    processor = processors.Add(name='add')
+    x = tf.zeros((2, 3), dtype=tf.float32) + 1.0
+    y = tf.zeros((2, 3), dtype=tf.float32) + 2.0
+    outputs = processor.get_outputs(x, y, keep_controls=False)
+    self.assertListEqual(['signal'], list(outputs['add'].keys()))
 
-class MixTest(tf.test.TestCase):
+    with self.cached_session() as sess:
+      actual = sess.run(outputs['add']['signal'])
 
-  def test_output_shape_is_correct(self):
-    processor = processors.Mix(name='mix')
+    expected = np.zeros((2, 3), dtype=np.float32) + 3.0
+
+    self.assertAllEqual(expected, actual)
+
+
+class MixTest(parameterized.TestCase, tf.test.TestCase):
+
+  @parameterized.named_parameters(
+      ('python', False),
+      ('jit_compile', True),
+  )
+  def test_output_shape_is_correct(self, jit_compile):
+    processor = processors.Mix(name='mix', jit_compile=jit_compile)
     x1 = np.zeros((2, 100, 3), dtype=np.float32) + 1.0
     x2 = np.zeros((2, 100, 3), dtype=np.float32) + 2.0
     mix_level = np.zeros(
@@ -123,6 +288,28 @@ class MixTest(tf.test.TestCase):
 
     self.assertListEqual([2, 100, 3], output.shape.as_list())
 
+  @parameterized.named_parameters(
+      ('python', False),
+      ('jit_compile', True),
+  )
+  def test_output_is_correct(self, jit_compile):
+    processor = processors.Mix(name='mix', jit_compile=jit_compile)
+    x1 = np.random.randn(2, 100, 3).astype(np.float32)
+    x2 = np.random.randn(2, 100, 3).astype(np.float32)
+    mix_level = np.linspace(0.0, 1.0, 200, dtype=np.float32)
+    mix_level = np.reshape(mix_level, (2, 100, 1))
+
+    output = processor.get_signal(x1, x2, mix_level)
+
+    with self.cached_session() as sess:
+      actual = sess.run(output)
+
+    # Constant-power crossfade, as computed before abs() was dropped.
+    expected = (np.sqrt(np.abs(mix_level)) * x1 +
+                (1.0 - np.sqrt(np.abs(mix_level - 1.0))) * x2)
+
+    self.assertAllClose(expected, actual)
+
 
 if __name__ == '__main__':
   tf.test.main()